@@ -1,36 +1,132 @@
+import csv
+import gzip
+import io
+import logging
 import os
 import sys
-import json
-from datetime import datetime
-from typing import List, Dict, Any, Optional
-
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from operator import itemgetter
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Set, Tuple
+
+import ijson
+import psycopg
 import requests
+from psycopg import sql
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from postgrest import SyncPostgrestClient
+from postgrest.types import ReturnMethod
 from supabase import create_client, Client
 
 
 WB_ACCEPTANCE_URL = "https://supplies-api.wildberries.ru/api/v1/acceptance/coefficients"
 
+# WB отдаёт коэффициенты на 14 дней вперёд начиная с сегодняшнего дня по Москве.
+MSK = timezone(timedelta(hours=3))
+
+# Уникальный ключ строки в таблице (см. migrations/) — по нему делаем upsert.
+CONFLICT_COLUMNS = "coeff_date,warehouse_id,box_type_id"
+
+# Колонки таблицы: в этом порядке normalize_rows собирает кортежи строк, с этим заголовком уходит CSV / COPY.
+COLUMNS = (
+    "coeff_date",
+    "warehouse_id",
+    "warehouse_name",
+    "box_type_id",
+    "coefficient",
+    "allow_unload",
+    "storage_coef",
+    "delivery_coef",
+    "delivery_base_liter",
+    "delivery_additional_liter",
+    "storage_base_liter",
+    "storage_additional_liter",
+    "is_sorting_center",
+)
+
+# Нормализованная строка — кортеж значений в порядке COLUMNS.
+Row = Tuple[Any, ...]
+# Достаёт из Row ключ (coeff_date, warehouse_id, box_type_id).
+row_key = itemgetter(*(COLUMNS.index(column) for column in CONFLICT_COLUMNS.split(",")))
+
+# Размер батча для upsert'а: 5000 строк — это ~1-2 МБ CSV и в 5 раз меньше HTTP round-trip'ов, чем 1000.
+BATCH_SIZE = 5000
+# Лимит тела запроса у шлюза Supabase ~8 МБ; батчи тяжелее этого порога делим пополам.
+MAX_BATCH_BYTES = 6 * 1024 * 1024
+
+# Сколько батчей upsert'им в Supabase одновременно (упираемся в RTT, а не в CPU).
+UPSERT_CONCURRENCY = 8
+# Размер страницы при чтении текущих строк из Supabase (PostgREST по умолчанию отдаёт не больше 1000 за запрос).
+EXISTING_PAGE_SIZE = 1000
+
+# Сколько warehouse_id перечисляем в одном in.(...) при удалении пропавших ключей — чтобы URL не разрастался.
+DELETE_IN_CHUNK = 200
+
+# Прогресс upsert'а пишем в лог раз в столько батчей, а не на каждый.
+LOG_EVERY_BATCHES = 10
+
+# Общая HTTP-сессия: переиспользует TCP/TLS-соединения (keep-alive) и повторяет GET на временных ошибках
+# WB (429/5xx) с экспоненциальной паузой, учитывая Retry-After. POST'ы (upsert) не ретраятся.
+# raise_on_status=False — после исчерпания ретраев отдаём последний ответ, его статус разбираем сами.
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.0,
+            respect_retry_after_header=True,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+logger = logging.getLogger("wb_acceptance_coefficients")
+
 
 def log(msg: str) -> None:
-    """Простой лог в stdout."""
-    print(msg, flush=True)
+    """Простой лог в stdout (через logging, настраивается в main)."""
+    logger.info(msg)
+
+
+def parse_warehouse_ids(value: Optional[str]) -> Optional[Set[int]]:
+    """"507,117501" -> {507, 117501}; None/пусто -> None (все склады)."""
+    if not value or not value.strip():
+        return None
+    try:
+        return {int(part) for part in value.split(",") if part.strip()}
+    except ValueError:
+        logger.error(f"ERROR: WB_WAREHOUSE_IDS must be a comma-separated list of integers, got: {value}")
+        sys.exit(1)
 
 
 def get_env(name: str, required: bool = True, default: Optional[str] = None) -> Optional[str]:
     value = os.getenv(name, default)
     if required and (value is None or value.strip() == ""):
-        log(f"ERROR: {name} is empty (set it in GitHub Secrets or env)")
+        logger.error(f"ERROR: {name} is empty (set it in GitHub Secrets or env)")
         sys.exit(1)
     return value
 
 
-def fetch_acceptance_coefficients(token: str, warehouse_ids: Optional[str] = None) -> List[Dict[str, Any]]:
+def fetch_acceptance_coefficients(token: str, warehouse_ids: Optional[str] = None) -> Iterator[Dict[str, Any]]:
     """
     Вытягивает коэффициенты приёмки с WB API.
     Если warehouse_ids=None -> по всем складам.
+    Ответ не материализуется целиком: строки отдаются по мере прихода байтов (ijson).
     """
     headers = {
-        "Authorization": token.strip()
+        "Authorization": token.strip(),
+        # явно просим сжатие; ACCEPT_ENCODING содержит только то, что urllib3 умеет распаковать (br — при наличии brotli)
+        "Accept-Encoding": ACCEPT_ENCODING,
     }
 
     params = {}
@@ -39,140 +135,450 @@ def fetch_acceptance_coefficients(token: str, warehouse_ids: Optional[str] = Non
         params["warehouseIDs"] = warehouse_ids
 
     log(f"Requesting WB acceptance coefficients (warehouseIDs={warehouse_ids or 'ALL'})...")
-    resp = requests.get(WB_ACCEPTANCE_URL, headers=headers, params=params, timeout=60)
+    try:
+        resp = SESSION.get(WB_ACCEPTANCE_URL, headers=headers, params=params, timeout=60, stream=True)
+    except requests.RequestException as e:
+        logger.error(f"ERROR: WB API request failed after retries: {e}")
+        sys.exit(1)
 
     if resp.status_code != 200:
-        log(f"ERROR: WB API {resp.status_code}: {resp.text}")
+        logger.error(f"ERROR: WB API {resp.status_code}: {resp.text}")
         sys.exit(1)
 
+    # читаем resp.raw напрямую, поэтому gzip/deflate надо распаковывать явно
+    resp.raw.decode_content = True
+    return iter_wb_rows(resp)
+
+
+def iter_wb_rows(resp: requests.Response) -> Iterator[Dict[str, Any]]:
+    """Потоково разбирает JSON-массив из ответа WB, отдавая строки по одной."""
+    count = 0
     try:
-        data = resp.json()
-    except json.JSONDecodeError:
-        log(f"ERROR: cannot decode WB response as JSON: {resp.text[:300]}")
-        sys.exit(1)
+        events = ijson.parse(resp.raw, use_float=True)
+        first = next(events, None)
+        if first is None or first[1] != "start_array":
+            logger.error(f"ERROR: unexpected WB format, expected list, got first JSON event: {first}")
+            sys.exit(1)
+
+        def all_events() -> Iterator[Any]:
+            yield first
+            yield from events
 
-    if not isinstance(data, list):
-        log(f"ERROR: unexpected WB format, expected list, got: {type(data)}; body snippet: {str(data)[:300]}")
+        for row in ijson.items(all_events(), "item"):
+            count += 1
+            yield row
+    except ijson.JSONError as e:
+        logger.error(f"ERROR: cannot decode WB response as JSON: {e}")
         sys.exit(1)
+    finally:
+        resp.close()
 
-    log(f"Fetched {len(data)} raw rows from WB")
-    return data
+    log(f"Fetched {count} raw rows from WB")
 
 
 def to_decimal(value: Any) -> Optional[float]:
     """Аккуратное приведение к float, если возможно."""
-    if value is None:
-        return None
-    if isinstance(value, (int, float)):
+    try:
+        # быстрый путь: числа (ijson отдаёт их сразу float'ами) и строки с точкой
         return float(value)
-    s = str(value).strip()
-    if s == "":
+    except (TypeError, ValueError):
+        pass
+    if value is None:
         return None
     try:
-        # WB иногда может отдавать строки, в том числе с точкой.
-        return float(s.replace(",", "."))
+        # WB иногда может отдавать строки, в том числе с запятой.
+        return float(str(value).strip().replace(",", "."))
     except ValueError:
         return None
 
 
-def normalize_rows(raw_rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def normalize_rows(raw_rows: Iterable[Dict[str, Any]], seen_keys: Optional[Set[Tuple[Any, ...]]] = None) -> Iterator[Row]:
     """
     Приводим формат WB к нашему табличному виду.
+    Генератор: строки отдаются по одной, полный список нигде не собирается.
+    Если передан seen_keys — в нём после прохода остаются все ключи (coeff_date, warehouse_id, box_type_id) выгрузки.
     """
-    norm: List[Dict[str, Any]] = []
+    count = 0
+    if seen_keys is None:
+        seen_keys = set()
+    # Названия складов повторяются на каждый день и тип коробки — держим по одному объекту str на склад.
+    name_cache: Dict[str, str] = {}
+    # локальные ссылки вместо поиска атрибутов/глобалов на каждой строке
+    num = to_decimal
 
     for row in raw_rows:
-        # date: string ("2024-04-11T00:00:00Z") -> date
-        date_str = row.get("date")  # пример: "2024-04-11T00:00:00Z"
-        if date_str:
-            try:
-                coeff_date = datetime.fromisoformat(date_str.replace("Z", "+00:00")).date()
-            except ValueError:
+        get = row.get
+
+        # date: string ("2024-04-11T00:00:00Z") -> "2024-04-11"
+        # Первые 10 символов ISO-строки — это и есть дата; datetime на каждую строку не разбираем,
+        # но форму YYYY-MM-DD проверяем: кривая дата уронила бы в БД весь батч, а не одну строку.
+        date_str = get("date")  # пример: "2024-04-11T00:00:00Z"
+        if not (
+            isinstance(date_str, str)
+            and len(date_str) >= 10
+            and date_str[4] == "-"
+            and date_str[7] == "-"
+            and date_str[:4].isdigit()
+            and date_str[5:7].isdigit()
+            and date_str[8:10].isdigit()
+        ):
+            if date_str:
                 # если вдруг формат странный — пропускаем строчку
-                log(f"WARN: cannot parse date '{date_str}', skip row")
-                continue
-        else:
+                logger.warning(f"WARN: cannot parse date '{date_str}', skip row")
             # без даты смысла нет, пропускаем
             continue
+        coeff_date = date_str[:10]
+
+        # upsert не переживёт два одинаковых ключа в одном батче — оставляем первую строку.
+        # Проверяем ключ до сборки dict'а, чтобы не приводить поля у дублей.
+        warehouse_id = get("warehouseID")
+        box_type_id = get("boxTypeID")
+        key = (coeff_date, warehouse_id, box_type_id)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+
+        warehouse_name = get("warehouseName") or ""
+        warehouse_name = name_cache.setdefault(warehouse_name, warehouse_name)
+
+        count += 1
+        # кортеж в порядке COLUMNS: без dict'а на каждую строку
+        yield (
+            coeff_date,  # Supabase сам приведёт в date
+            warehouse_id,
+            warehouse_name,
+            box_type_id,
+            num(get("coefficient")),
+            bool(get("allowUnload", False)),
+            num(get("storageCoef")),
+            num(get("deliveryCoef")),
+            num(get("deliveryBaseLiter")),
+            num(get("deliveryAdditionalLiter")),
+            num(get("storageBaseLiter")),
+            num(get("storageAdditionalLiter")),
+            bool(get("isSortingCenter", False)),
+        )
 
-        item = {
-            "coeff_date": coeff_date.isoformat(),  # Supabase сам приведёт в date
-            "warehouse_id": row.get("warehouseID"),
-            "warehouse_name": row.get("warehouseName") or "",
-            "box_type_id": row.get("boxTypeID"),
-            "coefficient": to_decimal(row.get("coefficient")),
-            "allow_unload": bool(row.get("allowUnload", False)),
-            "storage_coef": to_decimal(row.get("storageCoef")),
-            "delivery_coef": to_decimal(row.get("deliveryCoef")),
-            "delivery_base_liter": to_decimal(row.get("deliveryBaseLiter")),
-            "delivery_additional_liter": to_decimal(row.get("deliveryAdditionalLiter")),
-            "storage_base_liter": to_decimal(row.get("storageBaseLiter")),
-            "storage_additional_liter": to_decimal(row.get("storageAdditionalLiter")),
-            "is_sorting_center": bool(row.get("isSortingCenter", False)),
-        }
+    log(f"Normalized rows: {count}")
 
-        norm.append(item)
 
-    log(f"Normalized rows: {len(norm)}")
-    return norm
+def chunked(iterable: Iterable[Row], size: int) -> Iterator[List[Row]]:
+    """Разбивает поток на чанки фиксированного размера, не материализуя его целиком."""
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
 
 
-def chunked(iterable: List[Dict[str, Any]], size: int) -> List[List[Dict[str, Any]]]:
-    """Разбивает список на чанки фиксированного размера."""
-    return [iterable[i : i + size] for i in range(0, len(iterable), size)]
+def csv_value(value: Any) -> Any:
+    """Значение ячейки в формате, который понимает PostgREST: NULL — зарезервированное слово, bool — true/false."""
+    if value is None:
+        return "NULL"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return value
 
 
-def main() -> None:
-    # 🔐 Читаем переменные окружения
-    wb_token = get_env("WB_SUPPLIES_TOKEN", required=True)
-    supabase_url = get_env("SUPABASE_URL", required=True)
-    supabase_key = get_env("SUPABASE_SERVICE_KEY", required=True)
-    schema = get_env("SUPABASE_SCHEMA", required=False, default="public")
-    table_name = get_env("SUPABASE_TABLE", required=False, default="wb_acceptance_coefficients")
-    warehouse_ids = get_env("WB_WAREHOUSE_IDS", required=False, default=None)  # можно не задавать
+def encode_csv(batch: List[Row]) -> bytes:
+    """Кодирует батч в CSV с заголовком из COLUMNS."""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    writer.writerows([csv_value(value) for value in row] for row in batch)
+    return buf.getvalue().encode("utf-8")
 
-    # 📥 1) Тянем данные из WB
-    raw_rows = fetch_acceptance_coefficients(wb_token, warehouse_ids=warehouse_ids)
-    if not raw_rows:
-        log("No rows from WB, nothing to sync.")
-        return
 
-    # 🧹 2) Нормализуем
-    rows = normalize_rows(raw_rows)
-    if not rows:
-        log("No normalized rows, nothing to insert.")
-        return
+def encode_batches(
+    batch: List[Row], max_bytes: int = MAX_BATCH_BYTES, compress: bool = False
+) -> List[Tuple[int, bytes]]:
+    """
+    Кодирует батч в CSV; если тело больше max_bytes — делит батч пополам. Возвращает пары (кол-во строк, тело).
+    compress=True — тело дополнительно сжимается gzip'ом (лимит проверяется по несжатому размеру).
+    """
+    body = encode_csv(batch)
+    if len(batch) <= 1 or len(body) <= max_bytes:
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+        return [(len(batch), body)]
+    mid = len(batch) // 2
+    return encode_batches(batch[:mid], max_bytes, compress) + encode_batches(batch[mid:], max_bytes, compress)
 
-    # 🔗 3) Подключаемся к Supabase
-    sb: Client = create_client(supabase_url, supabase_key)
 
-    # 🗑 4) Удаляем старые данные ИЗ ТАБЛИЦЫ (нужно WHERE, иначе PostgREST ругается)
-    # Используем "мягкий truncate": удаляем всё, где coeff_date >= '1900-01-01' — то есть фактически все строки.
-    log(f"Deleting previous rows from {schema}.{table_name} ...")
-    try:
-        (
-            sb.schema(schema)
-            .table(table_name)
-            .delete()
-            .gte("coeff_date", "1900-01-01")
+def upsert_batch(url: str, headers: Dict[str, str], body: bytes) -> None:
+    """Upsert одного CSV-батча напрямую в PostgREST; return=minimal — ответ с пустым телом, ничего не парсим."""
+    resp = SESSION.post(url, headers=headers, data=body, timeout=120)
+    if resp.status_code not in (200, 201, 204):
+        raise RuntimeError(f"PostgREST {resp.status_code}: {resp.text[:300]}")
+
+
+def delete_stale_rows(db: SyncPostgrestClient, table_name: str, before: str) -> None:
+    """Удаляет строки с coeff_date < before; returning=minimal — ответ с пустым телом."""
+    (
+        db.table(table_name)
+        .delete(returning=ReturnMethod.minimal)
+        .lt("coeff_date", before)
+        .execute()
+    )
+
+
+def delete_missing_keys(db: SyncPostgrestClient, table_name: str, keys: Iterable[Tuple[Any, ...]]) -> int:
+    """
+    Удаляет строки по ключам (coeff_date, warehouse_id, box_type_id) — те, что пропали из выгрузки WB.
+    Ключи группируются по (coeff_date, box_type_id), warehouse_id уходят списком в in.(...). Возвращает число ключей.
+    """
+    grouped: Dict[Tuple[Any, Any], List[Any]] = {}
+    for coeff_date, warehouse_id, box_type_id in keys:
+        grouped.setdefault((coeff_date, box_type_id), []).append(warehouse_id)
+
+    deleted = 0
+    for (coeff_date, box_type_id), warehouse_ids in grouped.items():
+        for i in range(0, len(warehouse_ids), DELETE_IN_CHUNK):
+            (
+                db.table(table_name)
+                .delete(returning=ReturnMethod.minimal)
+                .eq("coeff_date", coeff_date)
+                .eq("box_type_id", box_type_id)
+                .in_("warehouse_id", warehouse_ids[i : i + DELETE_IN_CHUNK])
+                .execute()
+            )
+        deleted += len(warehouse_ids)
+    return deleted
+
+
+def load_existing_rows(db: SyncPostgrestClient, table_name: str, since: str) -> Set[Row]:
+    """Читает из таблицы строки с coeff_date >= since постранично и возвращает их кортежами в порядке COLUMNS."""
+    existing: Set[Row] = set()
+    offset = 0
+    while True:
+        resp = (
+            db.table(table_name)
+            .select(",".join(COLUMNS))
+            .gte("coeff_date", since)
+            .order("coeff_date")
+            .order("warehouse_id")
+            .order("box_type_id")
+            .range(offset, offset + EXISTING_PAGE_SIZE - 1)
             .execute()
         )
-        log("Previous rows deleted.")
+        existing.update(tuple(row[column] for column in COLUMNS) for row in resp.data)
+        if len(resp.data) < EXISTING_PAGE_SIZE:
+            return existing
+        offset += EXISTING_PAGE_SIZE
+
+
+def skip_unchanged(rows: Iterable[Row], existing: Set[Row]) -> Iterator[Row]:
+    """Пропускает строки, которые уже лежат в таблице с теми же значениями."""
+    skipped = 0
+    for row in rows:
+        if row in existing:
+            skipped += 1
+            continue
+        yield row
+    log(f"Unchanged rows skipped: {skipped}")
+
+
+def result_or_exit(future: Future, pool: ThreadPoolExecutor, what: str) -> Any:
+    """Дожидается задачи из пула и возвращает её результат; при ошибке гасит остальные задачи и завершает скрипт."""
+    try:
+        return future.result()
     except Exception as e:
-        log(f"ERROR while deleting old rows: {e}")
+        logger.error(f"ERROR while {what}: {e}")
+        pool.shutdown(cancel_futures=True)
         sys.exit(1)
 
-    # 📤 5) Вставляем новые данные чанками
-    BATCH_SIZE = 1000
-    for i, batch in enumerate(chunked(rows, BATCH_SIZE), start=1):
-        log(f"Inserting batch {i} with {len(batch)} rows...")
+
+def copy_rows(
+    database_url: str,
+    schema: str,
+    table_name: str,
+    rows: Iterable[Row],
+    before: str,
+    warehouse_ids: Optional[Set[int]] = None,
+) -> int:
+    """
+    Заливает строки напрямую в Postgres через COPY — на порядки быстрее батчей через PostgREST.
+    COPY идёт во временную таблицу, из неё — upsert по ключу (только новых и изменившихся строк),
+    удаление строк с coeff_date < before и строк окна (coeff_date >= before), чьих ключей нет в выгрузке
+    (при заданном warehouse_ids — только по этим складам).
+    Всё в одной транзакции: читатели до коммита видят старые данные, таблица не блокируется целиком.
+    Возвращает количество залитых строк.
+    """
+    key_columns = CONFLICT_COLUMNS.split(",")
+    target = sql.Identifier(schema, table_name)
+    stage = sql.Identifier("wb_acceptance_coefficients_stage")
+    columns = sql.SQL(", ").join(map(sql.Identifier, COLUMNS))
+    conflict = sql.SQL(", ").join(map(sql.Identifier, key_columns))
+    value_columns = [column for column in COLUMNS if column not in key_columns]
+    updates = sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column)) for column in value_columns)
+    changed = sql.SQL("({}) IS DISTINCT FROM ({})").format(
+        sql.SQL(", ").join(sql.Identifier("t", column) for column in value_columns),
+        sql.SQL(", ").join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(column)) for column in value_columns),
+    )
+
+    total = 0
+    with psycopg.connect(database_url) as conn, conn.cursor() as cur:
+        cur.execute(
+            sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA").format(
+                stage, columns, target
+            )
+        )
+        with cur.copy(sql.SQL("COPY {} ({}) FROM STDIN").format(stage, columns)) as copy:
+            for row in rows:
+                copy.write_row(row)
+                total += 1
+
+        # строки, у которых значения не поменялись, не перезаписываем
+        cur.execute(
+            sql.SQL("INSERT INTO {} AS t ({}) SELECT {} FROM {} ON CONFLICT ({}) DO UPDATE SET {} WHERE {}").format(
+                target, columns, columns, stage, conflict, updates, changed
+            )
+        )
+        log(f"New or changed rows upserted: {cur.rowcount}")
+        cur.execute(sql.SQL("DELETE FROM {} WHERE coeff_date < %s").format(target), (before,))
+        log(f"Stale rows deleted: {cur.rowcount}")
+
+        # Пустая выгрузка — не повод чистить окно целиком: пропавшие ключи удаляем, только если WB что-то отдал.
+        if total:
+            missing = sql.SQL(
+                "DELETE FROM {} AS t WHERE t.coeff_date >= %s AND NOT EXISTS ("
+                "SELECT 1 FROM {} AS s WHERE s.coeff_date = t.coeff_date "
+                "AND s.warehouse_id = t.warehouse_id AND s.box_type_id = t.box_type_id)"
+            ).format(target, stage)
+            params: List[Any] = [before]
+            if warehouse_ids is not None:
+                missing = missing + sql.SQL(" AND t.warehouse_id = ANY(%s)")
+                params.append(sorted(warehouse_ids))
+            cur.execute(missing, params)
+            log(f"Rows missing from WB payload deleted: {cur.rowcount}")
+
+    return total
+
+
+def main() -> None:
+    # Настраиваем только свой логгер: root остаётся на WARNING, и httpx (supabase-py) не пишет строку на каждый запрос.
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    # 🔐 Читаем переменные окружения
+    wb_token = get_env("WB_SUPPLIES_TOKEN", required=True)
+    supabase_url = get_env("SUPABASE_URL", required=True)
+    supabase_key = get_env("SUPABASE_SERVICE_KEY", required=True)
+    schema = get_env("SUPABASE_SCHEMA", required=False, default="public")
+    table_name = get_env("SUPABASE_TABLE", required=False, default="wb_acceptance_coefficients")
+    warehouse_ids = get_env("WB_WAREHOUSE_IDS", required=False, default=None)  # можно не задавать
+    warehouse_id_set = parse_warehouse_ids(warehouse_ids)
+    # Прямое подключение к Postgres (Supabase -> Database -> Connection string). Если задано — льём через COPY.
+    database_url = get_env("DATABASE_URL", required=False, default=None)
+    # Сжимать ли тело upsert'а gzip'ом (Content-Encoding: gzip). Включать, только если шлюз Supabase это принимает.
+    gzip_upload = get_env("SUPABASE_GZIP_UPLOAD", required=False, default="0") == "1"
+
+    today = datetime.now(MSK).date().isoformat()
+
+    if database_url:
+        # 📥 Тянем данные из WB, 🧹 нормализуем на лету и 📤 льём COPY'ем одной транзакцией
+        raw_rows = fetch_acceptance_coefficients(wb_token, warehouse_ids=warehouse_ids)
+        rows = normalize_rows(raw_rows)
+        log(f"Copying rows into {schema}.{table_name} via direct Postgres connection ...")
         try:
-            sb.schema(schema).table(table_name).insert(batch).execute()
-        except Exception as e:
-            log(f"ERROR while inserting batch {i}: {e}")
+            total = copy_rows(database_url, schema, table_name, rows, before=today, warehouse_ids=warehouse_id_set)
+        except psycopg.Error as e:
+            logger.error(f"ERROR while copying rows into Postgres: {e}")
             sys.exit(1)
+        log(f"Done. Copied total {total} rows into {schema}.{table_name}.")
+        return
+
+    # 🔗 1) Подключаемся к Supabase
+    sb: Client = create_client(supabase_url, supabase_key)
+    # sb.schema() каждый раз создаёт новый PostgREST-клиент со своим пулом соединений — берём его один раз
+    db = sb.schema(schema)
+
+    # Тело upsert'а — CSV, а не JSON: вдвое-втрое меньше байт в сети и дешевле в сборке. supabase-py CSV не умеет,
+    # поэтому пишем в PostgREST напрямую через общую SESSION.
+    upsert_url = f"{supabase_url.rstrip('/')}/rest/v1/{table_name}?on_conflict={CONFLICT_COLUMNS}"
+    upsert_headers = {
+        "apikey": supabase_key,
+        "Authorization": f"Bearer {supabase_key}",
+        "Content-Type": "text/csv",
+        "Content-Profile": schema,
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+    if gzip_upload:
+        upsert_headers["Content-Encoding"] = "gzip"
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=UPSERT_CONCURRENCY) as pool:
+        # 🗑 2) Удаляем устаревшие строки (прошедшие дни) в фоне, параллельно с запросом к WB:
+        # от выгрузки DELETE не зависит. Строки внутри окна WB перезапишет upsert ниже, а ключи окна,
+        # пропавшие из выгрузки, удаляются отдельно после её разбора (шаг 6).
+        log(f"Deleting stale rows (coeff_date < {today}) from {schema}.{table_name} in background ...")
+        delete_future: Optional[Future] = pool.submit(delete_stale_rows, db, table_name, today)
+        # Текущее содержимое окна тоже читаем в фоне — чтобы upsert'ить только то, что изменилось.
+        existing_future = pool.submit(load_existing_rows, db, table_name, today)
+
+        # 📥 3) Тянем данные из WB
+        # 🧹 4) Нормализуем на лету, пока ответ WB ещё докачивается, и отбрасываем неизменившиеся строки
+        raw_rows = fetch_acceptance_coefficients(wb_token, warehouse_ids=warehouse_ids)
+        existing = result_or_exit(existing_future, pool, "loading existing rows")
+        log(f"Existing rows in {schema}.{table_name}: {len(existing)}")
+        fresh_keys: Set[Tuple[Any, ...]] = set()
+        rows = skip_unchanged(normalize_rows(raw_rows, seen_keys=fresh_keys), existing)
+
+        # 📤 5) Upsert'им новые данные чанками по ключу (coeff_date, warehouse_id, box_type_id).
+        # Таблица при этом ни на момент не остаётся пустой — читатели всегда видят либо старые, либо новые строки.
+        # Батчи уходят в Supabase параллельно и сразу по мере готовности: fetch -> normalize -> upsert идут одним конвейером.
+        futures = {}
+        i = 0
+        for batch in chunked(rows, BATCH_SIZE):
+            if delete_future is not None:
+                # DELETE должен закончиться до первого upsert'а
+                result_or_exit(delete_future, pool, "deleting stale rows")
+                log("Stale rows deleted.")
+                delete_future = None
+            total += len(batch)
+            for size, body in encode_batches(batch, compress=gzip_upload):
+                i += 1
+                futures[pool.submit(upsert_batch, upsert_url, upsert_headers, body)] = (i, size)
+
+        if delete_future is not None:
+            result_or_exit(delete_future, pool, "deleting stale rows")
+            log("Stale rows deleted.")
+
+        # 🗑 6) Удаляем строки окна, чьих ключей больше нет в выгрузке WB (склад/тип коробки пропал на эту дату).
+        # При WB_WAREHOUSE_IDS выгрузка покрывает только эти склады — остальные не трогаем.
+        # Пустая выгрузка — не повод чистить окно целиком.
+        if fresh_keys:
+            existing_keys = (row_key(row) for row in existing)
+            missing_keys = [
+                key
+                for key in existing_keys
+                if key not in fresh_keys and (warehouse_id_set is None or key[1] in warehouse_id_set)
+            ]
+            if missing_keys:
+                missing_future = pool.submit(delete_missing_keys, db, table_name, missing_keys)
+                deleted = result_or_exit(missing_future, pool, "deleting rows missing from WB payload")
+                log(f"Rows missing from WB payload deleted: {deleted}")
+
+        done_batches = done_rows = 0
+        for future in as_completed(futures):
+            i, size = futures[future]
+            result_or_exit(future, pool, f"upserting batch {i}")
+            done_batches += 1
+            done_rows += size
+            if done_batches % LOG_EVERY_BATCHES == 0:
+                log(f"Upserted {done_batches}/{len(futures)} batches ({done_rows} rows) ...")
+
+    if not total:
+        log("No new or changed rows, nothing to upsert.")
+        return
 
-    log(f"Done. Inserted total {len(rows)} rows into {schema}.{table_name}.")
+    log(f"Done. Upserted total {total} new or changed rows into {schema}.{table_name}.")
 
 
 if __name__ == "__main__":
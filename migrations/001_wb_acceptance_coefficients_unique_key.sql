@@ -0,0 +1,5 @@
+-- Уникальный ключ для upsert'а из fetch_wb_acceptance_coefficients.py
+-- (on_conflict=coeff_date,warehouse_id,box_type_id).
+-- Если в таблице уже есть дубли по этому ключу, перед созданием индекса её нужно очистить.
+create unique index if not exists wb_acceptance_coefficients_key_uidx
+    on public.wb_acceptance_coefficients (coeff_date, warehouse_id, box_type_id);
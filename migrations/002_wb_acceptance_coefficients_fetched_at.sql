@@ -0,0 +1,21 @@
+-- fetched_at: когда строка последний раз пришла из WB с новыми значениями.
+-- fetch_wb_acceptance_coefficients.py upsert'ит только новые и изменившиеся строки,
+-- поэтому триггер обновляет fetched_at ровно тогда, когда значения действительно поменялись.
+alter table public.wb_acceptance_coefficients
+    add column if not exists fetched_at timestamptz not null default now();
+
+create or replace function public.wb_acceptance_coefficients_touch_fetched_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.fetched_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists wb_acceptance_coefficients_touch_fetched_at on public.wb_acceptance_coefficients;
+create trigger wb_acceptance_coefficients_touch_fetched_at
+    before insert or update on public.wb_acceptance_coefficients
+    for each row
+    execute function public.wb_acceptance_coefficients_touch_fetched_at();